@@ -1,9 +1,118 @@
+import collections
+import errno
 import logging
 import logging.handlers
+import os
 import socket
+import struct
+import sys
+import threading
 import time
+import traceback
+import weakref
 
-fqdn = socket.getfqdn()
+# Encoded HOSTNAME, resolved by _get_fqdn_b() on first use.
+_fqdn_b = None
+
+def _get_fqdn_b():
+    """ socket.getfqdn() may block on reverse DNS, so it is not called at
+    import.  Setting MINISYSLOG_FQDN skips the lookup altogether.
+    """
+
+    global _fqdn_b
+    if _fqdn_b is None:
+        name = os.environ.get('MINISYSLOG_FQDN') or socket.getfqdn()
+        _fqdn_b = name.encode('ascii', 'replace')
+    return _fqdn_b
+
+# Every possible '.mmmZ' timestamp suffix, indexed by millisecond.
+_MS = tuple(('.%03dZ' % i).encode('ascii') for i in range(1000))
+
+# Live handlers, so a forked child can give each one its own socket.
+_handlers = weakref.WeakSet()
+
+def _after_fork_in_child():
+    for handler in list(_handlers):
+        handler._reopen()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+# On Linux, sendmmsg(2) hands a whole run of UDP datagrams to the kernel in
+# one syscall.  It is reached through ctypes, and everything falls back to one
+# sendto() per datagram where it is missing.
+_sendmmsg = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+
+        class _iovec(ctypes.Structure):
+            _fields_ = [('iov_base', ctypes.c_char_p),
+                        ('iov_len', ctypes.c_size_t)]
+
+        class _msghdr(ctypes.Structure):
+            _fields_ = [('msg_name', ctypes.c_char_p),
+                        ('msg_namelen', ctypes.c_uint32),
+                        ('msg_iov', ctypes.POINTER(_iovec)),
+                        ('msg_iovlen', ctypes.c_size_t),
+                        ('msg_control', ctypes.c_void_p),
+                        ('msg_controllen', ctypes.c_size_t),
+                        ('msg_flags', ctypes.c_int)]
+
+        class _mmsghdr(ctypes.Structure):
+            _fields_ = [('msg_hdr', _msghdr),
+                        ('msg_len', ctypes.c_uint)]
+
+        _sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+        _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                              ctypes.c_uint, ctypes.c_int]
+        _sendmmsg.restype = ctypes.c_int
+    except (ImportError, OSError, AttributeError):
+        _sendmmsg = None
+
+# Largest batch sent as one datagram: the IPv4 UDP payload limit.
+_MAX_DATAGRAM = 65507
+
+# Kernel limit on datagrams per sendmmsg() call (UIO_MAXIOV).
+_SENDMMSG_MAX = 1024
+
+def _sockaddr(family, sa):
+    """ Pack a getaddrinfo() address tuple into a struct sockaddr. """
+
+    if family == socket.AF_INET:
+        host, port = sa
+        return (struct.pack('=H', family) + struct.pack('!H', port) +
+                socket.inet_pton(family, host) + b'\000' * 8)
+    host, port, flowinfo, scope_id = sa
+    return (struct.pack('=H', family) + struct.pack('!HI', port, flowinfo) +
+            socket.inet_pton(family, host.split('%')[0]) +
+            struct.pack('=I', scope_id))
+
+def _send_datagrams(sock, frames, name):
+    """ sendmmsg() every frame to the packed address name. """
+
+    count = len(frames)
+    iovs = (_iovec * count)()
+    msgs = (_mmsghdr * count)()
+    for i, frame in enumerate(frames):
+        iovs[i].iov_base = frame
+        iovs[i].iov_len = len(frame)
+        hdr = msgs[i].msg_hdr
+        hdr.msg_name = name
+        hdr.msg_namelen = len(name)
+        hdr.msg_iov = ctypes.pointer(iovs[i])
+        hdr.msg_iovlen = 1
+    fd = sock.fileno()
+    sent = 0
+    while sent < count:
+        n = _sendmmsg(fd, ctypes.byref(msgs[sent]),
+                      min(count - sent, _SENDMMSG_MAX), 0)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        sent += n
 
 class MiniSysLogHandler(logging.handlers.SysLogHandler):
     """ The SysLogHandler that ships in the Python stdlib doesn't generate
@@ -39,6 +148,14 @@ class MiniSysLogHandler(logging.handlers.SysLogHandler):
 
     This one assumes Zulu time, or UTC.
 
+    Pass message arguments lazily so that suppressed records are never
+    interpolated, and guard expensive argument construction with
+    logger.isEnabledFor()::
+
+    logger.info('x=%s', x)          # not logger.info(f'x={x}')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('state=%s', expensive_dump())
+
 
     Sample usage::
 
@@ -58,15 +175,53 @@ class MiniSysLogHandler(logging.handlers.SysLogHandler):
 	<14>1 2019-06-12T22:07:17.772Z img0 CoolApp TAG INFO [ourSDID@32473 super="cala" fraja="listic"] 
 
     """
+
+    # Seconds close() waits for the async_io worker to send what is queued.
+    close_timeout = 5.0
   
     def __init__(self,
                 appname = '-',
                 procid = '-',
                 msgid = '-',
                 address=('127.0.0.1', 514),
-                sd=False):
+                sd=False,
+                facility=logging.handlers.SysLogHandler.LOG_USER,
+                batch_bytes=0,
+                batch_interval=0.0,
+                socktype=None,
+                async_io=False,
+                queue_size=10000):
         """ Allow setting of APPNAME, PROCID, and MSGID at init. 
         XXX This version actually always sets MSGID to the loglevel (eg INFO, CRIT)        
+
+        facility is the syslog facility (LOG_USER by default); it may also be
+        reassigned on the handler later.
+
+        Setting batch_bytes and/or batch_interval buffers frames and sends
+        them in one write once that many bytes are pending or that many
+        seconds have passed since the last send.  This raises throughput at
+        the cost of latency; the interval is only checked when a record is
+        emitted, so call flush() to push out a quiet tail.  Over UDP a batch
+        becomes a single NUL-delimited datagram, which the receiver must
+        support; batches are capped at the largest UDP payload.  With
+        async_io the batch settings are ignored, since the worker already
+        sends whatever has queued up in one go.
+
+        socktype is passed to SysLogHandler; with socket.SOCK_STREAM the
+        frames go over TCP with Nagle's algorithm disabled, since a frame is
+        usually written on its own and would otherwise wait on the peer's
+        delayed ACK.
+
+        With async_io=True emit() only queues the frame; a daemon thread
+        owns the socket and sends whatever has queued up, so a slow or
+        stalled syslog server never blocks the logging thread.  Frames still
+        queued are sent by close(), which waits up to close_timeout seconds
+        for the thread and reports whatever it had to abandon.  At most
+        queue_size frames wait in the queue; while the worker is that far
+        behind, new frames are dropped and counted in the dropped attribute.
+
+        Forked children (gunicorn, uwsgi workers) get their own socket and,
+        with async_io, their own worker thread.
         """
 
         self.address = address
@@ -74,71 +229,481 @@ class MiniSysLogHandler(logging.handlers.SysLogHandler):
         self.msgid = msgid
         self.procid = procid
         self.sd = sd
-        super(MiniSysLogHandler, self).__init__()
+        # Last whole second formatted by _timestamp() and its encoding.
+        self._ts_sec = -1
+        self._ts_bytes = b''
+        # A subclass overriding get_timestamp() keeps having it honoured.
+        if type(self).get_timestamp is MiniSysLogHandler.get_timestamp:
+            self._ts = self._timestamp
+        else:
+            self._ts = self._encoded_timestamp
+        self.batch_bytes = batch_bytes
+        self.batch_interval = batch_interval
+        self._buf = bytearray()
+        self._last_flush = time.monotonic()
+        super(MiniSysLogHandler, self).__init__(address=address,
+                                                facility=facility,
+                                                socktype=socktype)
+        self._tune_socket()
+        self._refresh_send()
+
+        self.async_io = async_io
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._q = collections.deque()
+        self._wake = threading.Event()
+        self._closed = False
+        self._reconnect = False
+        self._worker = None
+        if async_io:
+            self._start_worker()
+        _handlers.add(self)
+
+    @property
+    def facility(self):
+        return self._facility
+
+    @facility.setter
+    def facility(self, value):
+        self._facility = value
+        self._build_level_tables()
+
+    def _build_level_tables(self):
+        """ Build the '<PRI>1 ' prefix and the encoded level name (used as
+        MSGID) for every known level, so emit() doesn't compute them per
+        record.
+
+        Setting facility rebuilds them.  Changes to priority_map, or
+        logging.addLevelName() renaming an existing level, are only picked
+        up on the next rebuild; reassign facility to force one.
+        """
+
+        pri_prefix = {}
+        level_bytes = {}
+        for levelno, levelname in logging._levelToName.items():
+            prio = self.encodePriority(self._facility,
+                                       self.mapPriority(levelname))
+            pri_prefix[levelno] = ('<%d>1 ' % prio).encode('ascii')
+            level_bytes[levelno] = levelname.encode('ascii')
+        self._pri_prefix = pri_prefix
+        self._level_bytes = level_bytes
+
+    @classmethod
+    def refresh_fqdn(cls):
+        """ Resolve the HOSTNAME again, for long-running daemons whose host
+        name changes.  The name is otherwise looked up once, on the first
+        record emitted, and looked up again on the next record after this.
+        """
+
+        global _fqdn_b
+        _fqdn_b = None
+        for handler in list(_handlers):
+            handler._invalidate_template()
+
+    def _invalidate_template(self):
+        """ Drop the frame template; emit() rebuilds it on the next record. """
+
+        self._frame_fmt = None
+
+    def _frame_template(self):
+        """ Build the frame template for this handler's fixed fields.
+
+        HOSTNAME, APPNAME, PROCID, the SD separator and the terminator (which
+        depends on the batch settings) only change through setters, so they
+        are baked into the template and emit() interpolates just PRI,
+        TIMESTAMP, MSGID and the body.
+        """
+
+        ident = b' %s %s %s ' % (_get_fqdn_b(), self._appname_b,
+                                 self._procid_b)
+        # With structured-data the message carries its own SD element,
+        # otherwise the NILVALUE '-' stands in for it.
+        sd_sep = b' ' if self._sd is True else b' - '
+        # A UDP datagram is its own delimiter, so the NUL terminator is only
+        # kept for stream and Unix sockets, and for batched UDP where it
+        # separates the records sharing a datagram.  async_io ignores the
+        # batch settings and sends one datagram per record.
+        batched = ((self._batch_bytes or self._batch_interval) and
+                   not self.async_io)
+        if self.append_nul and (self.unixsocket or
+                                self.socktype == socket.SOCK_STREAM or
+                                batched):
+            terminator = b'\000'
+        else:
+            terminator = b''
+        self._frame_fmt = (b'%s%s' + ident.replace(b'%', b'%%') + b'%s' +
+                           sd_sep + b'%s' + terminator)
+        return self._frame_fmt
+
+    @property
+    def appname(self):
+        return self._appname
+
+    @appname.setter
+    def appname(self, value):
+        # Keep the encoded form next to the str so emit() never re-encodes.
+        self._appname = value
+        self._appname_b = value.encode('ascii')
+        self._invalidate_template()
+
+    @property
+    def procid(self):
+        return self._procid
+
+    @procid.setter
+    def procid(self, value):
+        self._procid = value
+        self._procid_b = value.encode('ascii')
+        self._invalidate_template()
+
+    @property
+    def batch_bytes(self):
+        return self._batch_bytes
+
+    @batch_bytes.setter
+    def batch_bytes(self, value):
+        # Turning batching on or off changes the terminator.
+        self._batch_bytes = value
+        self._invalidate_template()
+
+    @property
+    def batch_interval(self):
+        return self._batch_interval
+
+    @batch_interval.setter
+    def batch_interval(self, value):
+        self._batch_interval = value
+        self._invalidate_template()
+
+    @property
+    def sd(self):
+        return self._sd
+
+    @sd.setter
+    def sd(self, value):
+        self._sd = value
+        self._invalidate_template()
     
     def get_timestamp(self, record):
         """ RFC 5424 timestamp with milliseconds from the LogRecord.  There is only ZULU time. """
 
-        ct = time.gmtime(record.created)
-        t = time.strftime('%Y-%m-%dT%H:%M:%S', ct)
-        s = '%s.%03dZ' % (t, record.msecs)
-        return s
+        return self._timestamp(record).decode('ascii')
+
+    def _encoded_timestamp(self, record):
+        """ An overridden get_timestamp(), encoded for emit(). """
+
+        return self.get_timestamp(record).encode('ascii')
+
+    def _timestamp(self, record):
+        """ get_timestamp() as bytes, for emit().
+
+        The seconds portion only changes once a second, so it is cached and
+        the milliseconds come from a lookup table.
+        """
+
+        sec = int(record.created)
+        if sec != self._ts_sec:
+            # Plain integer formatting; strftime would consult the locale.
+            self._ts_bytes = (b'%04d-%02d-%02dT%02d:%02d:%02d' %
+                              time.gmtime(sec)[:6])
+            self._ts_sec = sec
+        return self._ts_bytes + _MS[int(record.msecs)]
     
 
     def emit(self, record):
         """
         Emit an RFC 5424 compliant record.
 
-        The record is formatted, and then sent to the syslog server. If
-        exception information is present, it is NOT sent to the server.
+        The record is formatted, and then sent to the syslog server.  Any
+        exception traceback or stack information is appended to the message
+        by the formatter, as with other handlers.
         """
+        # Records below the handler level never reach the wire, so skip
+        # formatting them at all.
+        if self.level and record.levelno < self.level:
+            return
+
         try:
 
-            msg = self.format(record) + '\000'
+            levelno = record.levelno
+            try:
+                prio = self._pri_prefix[levelno]
+                lvl = self._level_bytes[levelno]
+            except KeyError:
+                # Custom level registered after the handler was created.
+                prio = ('<%d>1 ' % self.encodePriority(
+                                    self.facility,
+                                    self.mapPriority(record.levelname))).encode('ascii')
+                lvl = record.levelname.encode('ascii')
+
+            ts = self._ts(record)
+
+            # Without a formatter, and with no traceback or stack to append,
+            # the body is just the message, so skip the Formatter call chain.
+            if (self.formatter is None and not record.exc_info and
+                    not record.exc_text and not record.stack_info):
+                text = record.msg
+                if record.args or type(text) is not str:
+                    text = record.getMessage()
+            else:
+                text = self.format(record)
+
+            # Message is a string. Convert to bytes as required by RFC 5424
+            body = text.encode('utf-8')
+
+            fmt = self._frame_fmt
+            if fmt is None:
+                fmt = self._frame_template()
+            msg = fmt % (prio, ts, lvl, body)
+
+            if self._closed:
+                raise OSError(errno.EBADF, 'handler is closed')
+            if self.async_io:
+                if len(self._q) >= self.queue_size:
+                    # The worker can't keep up, e.g. a stalled TCP peer.
+                    self.dropped += 1
+                    return
+                self._q.append(msg)
+                # Checking first keeps the Event's lock off the hot path
+                # while the worker is already awake.
+                if not self._wake.is_set():
+                    self._wake.set()
+            elif self._batch_bytes or self._batch_interval:
+                buf = self._buf
+                limit = self._batch_limit()
+                # Send what is pending first if this frame would overflow it.
+                if buf and len(buf) + len(msg) > limit:
+                    self._flush_buf()
+                buf += msg
+                if (len(buf) >= limit or
+                    (self._batch_interval and
+                     time.monotonic() - self._last_flush >= self._batch_interval)):
+                    self._flush_buf()
+            else:
+                self._send(msg)
+        except Exception:
+            self.handleError(record)
 
-            # We need to convert record level to lowercase, maybe this will
-            # change in the future.
+    def _batch_limit(self):
+        """ Bytes a batch may hold before it has to be sent. """
 
-            prio = '<%d>1 ' % self.encodePriority(
-                                self.facility,
-                                self.mapPriority(record.levelname))
+        limit = self._batch_bytes or sys.maxsize
+        if self.socktype == socket.SOCK_DGRAM:
+            # The whole batch goes out as one datagram.
+            limit = min(limit, _MAX_DATAGRAM)
+        return limit
 
+    def _handle_send_error(self):
+        """ handleError() for a send that isn't tied to a single record. """
 
-            if type(msg) is unicode:
-                msg = msg.encode('utf-8')
-            ts = self.get_timestamp(record)
+        if logging.raiseExceptions and sys.stderr:
+            traceback.print_exc(file=sys.stderr)
 
-            # Message is a string. Convert to bytes as required by RFC 5424
-            msg = msg.encode('utf-8')
-
-            if self.sd is True:
-                msg = prio + '%s %s %s %s %s %s' % (ts,
-                                                   fqdn,
-                                                   self.appname,
-                                                   self.procid,
-                                                   record.levelname,
-                                                   msg)
-            else:
-                msg = prio + '%s %s %s %s %s - %s' % (ts,
-                                                   fqdn,
-                                                   self.appname,
-                                                   self.procid,
-                                                   record.levelname,
-                                                   msg)
-                
-            if self.unixsocket:
+    def _tune_socket(self):
+        """ Socket options for the freshly created socket. """
+
+        if not self.unixsocket and self.socktype == socket.SOCK_STREAM:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _refresh_send(self):
+        """ Bind self._send to the send call for the current socket.
+
+        This hoists the choice of transport out of the per-record path;
+        call it again whenever self.socket or self.address is replaced.
+        """
+
+        if self.unixsocket:
+            self._send = self._send_unix
+        elif self.socktype == socket.SOCK_DGRAM:
+            sendto, address = self.socket.sendto, self.address
+            self._send = lambda msg: sendto(msg, address)
+        else:
+            self._send = self.socket.sendall
+        # Packed destination for sendmmsg(), resolved on first use.
+        self._mm_name = None
+
+    def _send_reconnect(self, msg):
+        """ Stands in for the send method after a failed reopen. """
+
+        self._create_socket()
+        self._tune_socket()
+        self._reconnect = False
+        self._refresh_send()
+        self._send(msg)
+
+    def _send_closed(self, msg):
+        """ Stands in for the send method once the handler is closed. """
+
+        raise OSError(errno.EBADF, 'handler is closed')
+
+    def _send_unix(self, msg):
+        """ Send on the Unix socket, reconnecting once if syslogd restarted. """
+
+        try:
+            self.socket.send(msg)
+        except OSError:
+            self.socket.close()
+            self._connect_unixsocket(self.address)
+            self._refresh_send()
+            self.socket.send(msg)
+
+    def _reopen(self):
+        """ Replace the socket inherited across fork() with a new one.
+
+        Otherwise every child of a pre-forking server writes through the
+        same descriptor and serialises on it in the kernel.  The worker
+        thread does not survive fork(), so it is restarted; anything the
+        parent had queued or batched is dropped, as the parent sends it.
+        """
+
+        if self._closed:
+            return
+        self._q.clear()
+        self._buf.clear()
+        self._wake = threading.Event()
+        # Make the new socket before letting go of the inherited one.
+        old = self.socket
+        try:
+            self._create_socket()
+            self._tune_socket()
+        except OSError:
+            # Never fall back to the parent's connection; the next send
+            # retries, and reports the real error if that fails too.
+            self._reconnect = True
+            self._send = self._send_reconnect
+        else:
+            self._refresh_send()
+        if old is not None:
+            old.close()
+        if self._worker is not None:
+            self._start_worker()
+
+    def _create_socket(self):
+        """ createSocket(), which SysLogHandler only has from Python 3.11. """
+
+        if hasattr(logging.handlers.SysLogHandler, 'createSocket'):
+            self.createSocket()
+        elif self.unixsocket:
+            self._connect_unixsocket(self.address)
+        else:
+            sock = socket.socket(self.socket.family, self.socktype)
+            if self.socktype == socket.SOCK_STREAM:
                 try:
-                    self.socket.send(msg)
+                    sock.connect(self.address)
                 except OSError:
-                    self.socket.close()
-                    self._connect_unixsocket(self.address)
-                    self.socket.send(msg)
-            elif self.socktype == socket.SOCK_DGRAM:
-                self.socket.sendto(msg, self.address)
-            else:
-                self.socket.sendall(msg)
+                    sock.close()
+                    raise
+            self.socket = sock
+
+    def _start_worker(self):
+        self._worker = threading.Thread(target=self._drain,
+                                        name='MiniSysLogHandler',
+                                        daemon=True)
+        self._worker.start()
+
+    def _drain(self):
+        """ Worker loop: send everything queued, then sleep until woken. """
+
+        q = self._q
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            frames = []
+            while q:
+                frames.append(q.popleft())
+            if frames:
+                try:
+                    self._send_frames(frames)
+                except Exception:
+                    self._handle_send_error()
+            if self._closed and not q:
+                return
+
+    def _send_frames(self, frames):
+        """ Send a run of frames, one write per stream or one per datagram. """
+
+        if self.socktype == socket.SOCK_STREAM:
+            self._send(b''.join(frames))
+        elif (_sendmmsg is not None and not self.unixsocket and
+              not self._reconnect and len(frames) > 1):
+            if self._mm_name is None:
+                family = self.socket.family
+                host, port = self.address
+                sa = socket.getaddrinfo(host, port, family,
+                                        socket.SOCK_DGRAM)[0][4]
+                self._mm_name = _sockaddr(family, sa)
+            _send_datagrams(self.socket, frames, self._mm_name)
+        else:
+            for frame in frames:
+                self._send(frame)
+
+    def flush(self):
+        """ Send any batched frames in a single write.
+
+        With async_io this just wakes the worker; it does not wait for it.
+        A failed send is reported like handleError() rather than raised.
+        """
+
+        if self._worker is not None:
+            self._wake.set()
+            return
+
+        try:
+            self._flush_buf()
         except Exception:
-            self.handleError(record)
+            self._handle_send_error()
+
+    def _flush_buf(self):
+        """ flush() for emit(), raising send errors for handleError(). """
+
+        self.acquire()
+        try:
+            if self._buf:
+                # Send straight out of the buffer rather than a bytes copy.
+                try:
+                    with memoryview(self._buf) as view:
+                        self._send(view)
+                finally:
+                    # Drop the batch even if the send failed so a dead peer
+                    # can't make the buffer grow without bound.
+                    self._buf.clear()
+            self._last_flush = time.monotonic()
+        finally:
+            self.release()
+
+    def close(self):
+        """ Flush pending frames, then release the batch buffer and the
+        bound send method along with the socket.  Records emitted afterwards
+        fail with EBADF.
+        """
+
+        self._closed = True
+        if self._worker is not None:
+            self._wake.set()
+            self._worker.join(self.close_timeout)
+            if self._worker.is_alive():
+                # Stuck in a send to a stalled peer.  Shutting the socket
+                # down fails that send, and the worker exits once the queue
+                # is empty.
+                pending = len(self._q)
+                self._q.clear()
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                if logging.raiseExceptions and sys.stderr:
+                    sys.stderr.write('MiniSysLogHandler: worker still sending '
+                                     'after %.1fs, dropped %d queued frames\n'
+                                     % (self.close_timeout, pending))
+            self._worker = None
+        self.flush()
+        self.acquire()
+        try:
+            self._buf = bytearray()
+            self._send = self._send_closed
+        finally:
+            self.release()
+        super(MiniSysLogHandler, self).close()
 
 
 
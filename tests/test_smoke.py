@@ -0,0 +1,157 @@
+""" Loopback smoke tests: records built by MiniSysLogHandler reach a local
+socket in each sending mode.
+
+Run with::
+
+    python -m unittest discover -s tests
+"""
+
+import importlib.util
+import logging
+import os
+import socket
+import sys
+import unittest
+
+os.environ.setdefault('MINISYSLOG_FQDN', 'testhost')
+
+_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     os.pardir, '__init__.py')
+_spec = importlib.util.spec_from_file_location('minisysloghandler', _path)
+minisyslog = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(minisyslog)
+MiniSysLogHandler = minisyslog.MiniSysLogHandler
+
+
+def record(msg, levelno=logging.INFO):
+    return logging.makeLogRecord({'msg': msg,
+                                  'levelno': levelno,
+                                  'levelname': logging.getLevelName(levelno)})
+
+
+class UDPTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(2)
+        self.addCleanup(self.server.close)
+
+    def handler(self, **kwargs):
+        h = MiniSysLogHandler(appname='App', procid='TAG',
+                              address=self.server.getsockname(), **kwargs)
+        self.addCleanup(h.close)
+        return h
+
+    def test_plain(self):
+        h = self.handler()
+        h.handle(record('hello %s' % 'w\xf6rld'))
+        h.sd = True
+        h.handle(record('[x@1 a="b"] sd', logging.WARNING))
+        data = self.server.recv(65535)
+        self.assertRegex(data, rb'^<14>1 \d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z '
+                               rb'testhost App TAG INFO - hello w\xc3\xb6rld$')
+        self.assertTrue(self.server.recv(65535).endswith(
+            b' testhost App TAG WARNING [x@1 a="b"] sd'))
+
+    def test_batch(self):
+        h = self.handler(batch_bytes=4096)
+        for i in range(3):
+            h.handle(record('rec%d' % i))
+        h.flush()
+        frames = self.server.recv(65535).split(b'\000')
+        self.assertEqual(frames[-1], b'')
+        self.assertEqual([f[-4:] for f in frames[:-1]],
+                         [b'rec0', b'rec1', b'rec2'])
+
+    def test_batch_stays_within_datagram(self):
+        h = self.handler(batch_interval=60)
+        for i in range(70):
+            h.handle(record('x' * 1024))
+        h.flush()
+        count = 0
+        while count < 70:
+            count += self.server.recv(65535).count(b'\000')
+        self.assertEqual(count, 70)
+
+    def test_async(self):
+        h = self.handler(async_io=True)
+        for i in range(100):
+            h.handle(record('rec%d' % i))
+        h.close()
+        got = [self.server.recv(65535) for i in range(100)]
+        self.assertEqual(got[-1][-5:], b'rec99')
+
+    @unittest.skipIf(minisyslog._sendmmsg is None, 'sendmmsg not available')
+    def test_sendmmsg(self):
+        calls = []
+        send_datagrams = minisyslog._send_datagrams
+        def spy(*args):
+            calls.append(len(args[1]))
+            send_datagrams(*args)
+        minisyslog._send_datagrams = spy
+        self.addCleanup(setattr, minisyslog, '_send_datagrams', send_datagrams)
+        h = self.handler()
+        frames = [b'frame %d' % i for i in range(1500)]
+        h._send_frames(frames)
+        self.assertEqual(calls, [1500])
+        got = [self.server.recv(65535) for i in range(1500)]
+        self.assertEqual(got, frames)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+    def test_fork(self):
+        h = self.handler()
+        h.handle(record('parent'))
+        _, parent_addr = self.server.recvfrom(65535)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                h.handle(record('child'))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        data, child_addr = self.server.recvfrom(65535)
+        self.assertTrue(data.endswith(b' child'))
+        # The child reopened the socket rather than sharing the parent's.
+        self.assertNotEqual(child_addr, parent_addr)
+
+    def test_emit_after_close(self):
+        h = self.handler()
+        h.close()
+        errors = []
+        h.handleError = lambda rec: errors.append(sys.exc_info()[1])
+        h.handle(record('late'))
+        self.assertIsInstance(errors[0], OSError)
+
+
+class TCPTest(unittest.TestCase):
+
+    def test_async_stream(self):
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        h = MiniSysLogHandler(address=server.getsockname(),
+                              socktype=socket.SOCK_STREAM, async_io=True)
+        conn, _ = server.accept()
+        self.addCleanup(conn.close)
+        conn.settimeout(2)
+        self.assertEqual(h.socket.getsockopt(socket.IPPROTO_TCP,
+                                             socket.TCP_NODELAY), 1)
+        for i in range(1000):
+            h.handle(record('rec%d' % i))
+        h.close()
+        data = b''
+        while True:
+            chunk = conn.recv(65535)
+            if not chunk:
+                break
+            data += chunk
+        frames = data.split(b'\000')
+        self.assertEqual(len(frames), 1001)
+        self.assertTrue(frames[999].endswith(b'rec999'))
+
+
+if __name__ == '__main__':
+    unittest.main()